@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+
+"""
+Roll a SSL/TLS certificate out to a fleet of TrueNAS SCALE systems in waves.
+
+Each section in the config file describes one NAS, exactly as for deploy_truenas.py.
+This script runs deploy_truenas.py against those sections in waves: a small canary
+wave first, then growing percentages of the fleet.  After every wave, each NAS that
+was deployed to must pass its health gates (the web UI serves the new certificate
+over a TLS handshake, and every app using a certificate has been switched to the new
+one and isn't left deploying or crashed) before the next wave starts.  If any canary
+fails, the rollout stops.  This avoids restarting the UI and apps on every NAS at once.
+
+The wave schedule is read from the [fleet] section of the config file.
+
+Source: https://github.com/danb35/deploy-freenas
+"""
+
+import argparse
+import os
+import time
+import configparser
+import logging
+import math
+import re
+import ssl
+import subprocess
+import sys
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from truenas_api_client import Client
+from OpenSSL import crypto
+
+parser = argparse.ArgumentParser(description='Deploy a SSL/TLS certificate to a fleet of TrueNAS systems in waves.',exit_on_error=False)
+parser.add_argument('-c', '--config', default=(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+    'deploy_config')), help='Path to config file, defaults to deploy_config.')
+parser.add_argument('-f', '--fleet', help='Use the specified config section for the wave schedule, default is "fleet"')
+try:
+  args = parser.parse_args()
+except argparse.ArgumentError:
+  parser.print_usage()
+  sys.exit(1)
+
+logging.basicConfig (format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                     handlers=[
+                         logging.StreamHandler()
+                     ])
+logger = logging.getLogger()
+
+FLEET_SECTION = args.fleet or 'fleet'
+if os.path.isfile(args.config):
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    if FLEET_SECTION in config:
+        fleet = config[FLEET_SECTION]
+    elif args.fleet:
+        logger.critical(f"Fleet section {args.fleet} not found in the config file")
+        sys.exit(1)
+    else:
+        fleet = config[config.default_section]
+else:
+    print("Config file", args.config, "does not exist!")
+    sys.exit(1)
+
+LOG = fleet.get('log_level',"INFO")
+logger.setLevel(getattr(logging, LOG.upper(), logging.INFO))
+
+# Initialize variables
+DEPLOY_SCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'deploy_truenas.py')
+try:
+    SECTIONS = [s.strip() for s in fleet.get('sections', "").split(',') if s.strip()]
+    CANARY = fleet.getint('canary', fallback=1)
+    WAVES = [float(w) for w in fleet.get('waves', "25, 50, 100").split(',') if w.strip()]
+    CONCURRENCY = fleet.getint('concurrency', fallback=4)
+    SITE_RATE_LIMIT = fleet.getfloat('site_rate_limit', fallback=0)
+    MAX_FAILURES = fleet.getint('max_failures', fallback=0)
+    HEALTH_TIMEOUT = fleet.getint('health_timeout', fallback=300)
+    HEALTH_INTERVAL = fleet.getint('health_interval', fallback=10)
+    DEPLOY_TIMEOUT = fleet.getint('deploy_timeout', fallback=1800)
+except (ValueError, configparser.Error) as e:
+    logger.critical(f"Invalid setting in [{FLEET_SECTION}]: {e}")
+    sys.exit(1)
+if not SECTIONS:
+    SECTIONS = [s for s in config.sections() if s not in (FLEET_SECTION, 'fleet')]
+
+missing = [s for s in SECTIONS if s not in config]
+if missing:
+    logger.critical(f"Sections not found in the config file: {', '.join(missing)}")
+    sys.exit(1)
+if not SECTIONS:
+    logger.critical("No sections to deploy to.")
+    sys.exit(1)
+if CONCURRENCY < 1:
+    logger.critical("concurrency must be at least 1")
+    sys.exit(1)
+if CANARY < 0:
+    logger.critical("canary must not be negative")
+    sys.exit(1)
+if any(w <= 0 or w > 100 for w in WAVES):
+    logger.critical("waves must be percentages between 0 and 100")
+    sys.exit(1)
+if SITE_RATE_LIMIT < 0:
+    logger.critical("site_rate_limit must not be negative")
+    sys.exit(1)
+if MAX_FAILURES < 0:
+    logger.critical("max_failures must not be negative")
+    sys.exit(1)
+if HEALTH_TIMEOUT < 0:
+    logger.critical("health_timeout must not be negative")
+    sys.exit(1)
+if HEALTH_INTERVAL < 1:
+    logger.critical("health_interval must be at least 1")
+    sys.exit(1)
+if DEPLOY_TIMEOUT < 1:
+    logger.critical("deploy_timeout must be at least 1")
+    sys.exit(1)
+
+def plan_waves(sections, canary, waves):
+    """Split sections into a canary wave followed by cumulative percentage waves."""
+    planned = []
+    done = min(max(canary, 0), len(sections))
+    if done:
+        planned.append(sections[:done])
+    for percent in waves:
+        count = min(math.ceil(len(sections) * percent / 100), len(sections))
+        if count > done:
+            planned.append(sections[done:count])
+            done = count
+    if done < len(sections):
+        planned.append(sections[done:])
+    return planned
+
+# Deployment
+
+failures = 0
+failures_lock = threading.Lock()
+
+def record_failure(label, reason):
+    global failures
+    with failures_lock:
+        failures += 1
+        logger.error(f"❌ {label}: {reason} ({failures} failure(s), {MAX_FAILURES} allowed)")
+
+def budget_exhausted():
+    with failures_lock:
+        return failures > MAX_FAILURES
+
+class SiteRateLimiter:
+    """Space out deployment starts on each site to at most rate per minute.
+
+    Only used from the main loop, which submits a section to the pool once its
+    site is ready, so no worker ever sleeps while holding a slot.
+    """
+
+    def __init__(self, rate):
+        self.interval = 60.0 / rate if rate > 0 else 0
+        self.next_start = {}
+
+    def try_start(self, site):
+        """Reserve a start on site if it's allowed now.  Returns True if reserved."""
+        now = time.monotonic()
+        if self.next_start.get(site, now) > now:
+            return False
+        self.next_start[site] = now + self.interval
+        return True
+
+    def delay(self, sites):
+        """Seconds until the first of sites is allowed to start."""
+        now = time.monotonic()
+        return max(0, min(self.next_start.get(site, now) for site in sites) - now)
+
+limiter = SiteRateLimiter(SITE_RATE_LIMIT)
+
+def site_of(label):
+    section = config[label]
+    return section.get('site', section.get('connect_host', "localhost"))
+
+def log_output(label, level, stdout, stderr):
+    if isinstance(stdout, bytes):
+        stdout = stdout.decode(errors='replace')
+    if isinstance(stderr, bytes):
+        stderr = stderr.decode(errors='replace')
+    output = f"{stderr or ''}{stdout or ''}".strip()
+    if output:
+        logger.log(level, f"{label} output:\n{output}")
+
+def deploy(label):
+    """Run deploy_truenas.py for one section.  Returns True on success."""
+    section = config[label]
+    if section.getboolean('apps_enabled', fallback=False):
+        try:
+            unhealthy_before[label] = unhealthy_apps(section)
+            if unhealthy_before[label]:
+                logger.warning(f"{label}: apps already unhealthy before deploying, not gating on them: "
+                               f"{', '.join(sorted(unhealthy_before[label]))}")
+        except Exception as e:
+            logger.warning(f"{label}: could not check app states before deploying: {e}")
+    logger.info(f"Deploying to {label}.")
+    try:
+        result = subprocess.run([sys.executable, DEPLOY_SCRIPT, '-c', args.config, label],
+                                capture_output=True, text=True, timeout=DEPLOY_TIMEOUT)
+    except subprocess.TimeoutExpired as e:
+        log_output(label, logging.ERROR, e.stdout, e.stderr)
+        record_failure(label, f"deployment timed out after {DEPLOY_TIMEOUT}s")
+        return False
+    except Exception as e:
+        record_failure(label, f"deployment could not be run: {e}")
+        return False
+    if result.returncode != 0:
+        log_output(label, logging.ERROR, result.stdout, result.stderr)
+        record_failure(label, f"deployment exited with status {result.returncode}")
+        return False
+    log_output(label, logging.DEBUG, result.stdout, result.stderr)
+    logger.info(f"✅ Deployed to {label}.")
+    return True
+
+def deploy_wave(pool, wave):
+    """Deploy to every section in wave, pacing starts per site.
+
+    Returns the sections deployed and the sections skipped once the failure budget ran out.
+    """
+    pending = list(wave)
+    running = {}
+    deployed = []
+    skipped = []
+    while pending or running:
+        if budget_exhausted() and pending:
+            logger.warning(f"Failure budget exhausted, not deploying to {', '.join(pending)}.")
+            skipped, pending = pending, []
+        for label in list(pending):
+            if len(running) >= CONCURRENCY:
+                break
+            if limiter.try_start(site_of(label)):
+                pending.remove(label)
+                running[pool.submit(deploy, label)] = label
+        timeout = None
+        if pending and len(running) < CONCURRENCY:
+            timeout = limiter.delay([site_of(label) for label in pending])
+            logger.debug(f"Rate limiting, next start in {timeout:.1f}s")
+        if not running:
+            if timeout:
+                time.sleep(timeout)
+            continue
+        done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            label = running.pop(future)
+            if future.result():
+                deployed.append(label)
+    return [label for label in wave if label in deployed], skipped
+
+# Health gates
+
+def pem_fingerprint(pem):
+    """SHA256 fingerprint of the first (leaf) certificate in PEM data."""
+    certs = re.findall(r"-----BEGIN CERTIFICATE-----.*?-----END CERTIFICATE-----",
+                       pem, re.DOTALL)
+    if not certs:
+        raise ValueError("No valid certificate found in the provided PEM data.")
+    return crypto.load_certificate(crypto.FILETYPE_PEM, certs[0]).digest('sha256').decode()
+
+def leaf_fingerprint(section):
+    """SHA256 fingerprint of the leaf cert in the section's full chain file."""
+    with open(section.get('fullchain_path'), 'r') as file:
+        return pem_fingerprint(file.read())
+
+def served_fingerprint(section):
+    """SHA256 fingerprint of the cert presented by the NAS web UI."""
+    host = section.get('connect_host', "localhost")
+    port = 443
+    if section.get('protocol', "ws") == "wss" and section.get('connect_port', "") != "":
+        port = section.getint('connect_port')
+    port = section.getint('tls_port', fallback=port)
+    return pem_fingerprint(ssl.get_server_certificate((host, port), timeout=10))
+
+def api_uri(section):
+    # Same API path detection as deploy_truenas.py
+    host = section.get('connect_host', "localhost")
+    port = section.get('connect_port', "")
+    port_http = section.get('connect_port_http', "")
+    port = ":" + port if port != "" else ""
+    port_http = ":" + port_http if port_http != "" else ""
+    api_path = "/websocket"
+    try:
+        response = requests.get(f"http://{host}{port_http}/api/versions", timeout=10)
+        response.raise_for_status()
+        data = response.json()
+        if isinstance(data, list) and all(isinstance(v, str) and v.startswith("v") for v in data):
+            api_path = "/api/current"
+    except Exception as e:
+        logger.debug(f"Failed to retrieve API versions from {host}: {e}")
+    return f"{section.get('protocol', 'ws')}://{host}{port}{api_path}"
+
+# Apps that were already deploying or crashed before each section was deployed to
+unhealthy_before = {}
+
+def connect(section):
+    c = Client(uri=api_uri(section), verify_ssl=section.getboolean('verify_ssl', fallback=True))
+    try:
+        if c.call("auth.login_with_api_key", section.get('api_key')) == False:
+            raise RuntimeError("Failed to authenticate!")
+    except Exception:
+        c.close()
+        raise
+    return c
+
+def certificate_apps(c):
+    """Yield (app, app_config) for the apps deploy_truenas.py updates."""
+    for app in c.call("app.query"):
+        app_config = c.call("app.config", (app["id"]))
+        if 'ix_certificates' in app_config and app_config['ix_certificates']:
+            yield app, app_config
+
+def unhealthy_apps(section):
+    """Return the set of certificate apps currently deploying or crashed."""
+    with connect(section) as c:
+        return {app['id'] for app, _ in certificate_apps(c) if app.get('state') in ('DEPLOYING', 'CRASHED')}
+
+def app_problems(section, label, expected):
+    """Return a list of certificate app problems, or None if all apps are updated and settled.
+
+    Only apps that deploy_truenas.py updates (those with ix_certificates configured)
+    are checked, and apps that were already unhealthy before the deploy are ignored.
+    Each remaining app must be using the certificate whose fingerprint is expected,
+    which catches app.update jobs that failed without failing deploy_truenas.py.
+    """
+    skip = unhealthy_before.get(label, set())
+    with connect(section) as c:
+        cert_base_name = section.get('cert_base_name', 'letsencrypt')
+        new_cert_ids = {cert['id'] for cert in c.call("certificate.query")
+                        if cert['name'].startswith(cert_base_name) and cert.get('certificate')
+                        and pem_fingerprint(cert['certificate']) == expected}
+        if not new_cert_ids:
+            return ["new certificate not found on the NAS"]
+        problems = []
+        for app, app_config in certificate_apps(c):
+            if app['id'] in skip:
+                continue
+            cert_id = app_config.get('network', {}).get('certificate_id')
+            if cert_id not in new_cert_ids:
+                problems.append(f"{app['id']} is using certificate {cert_id}")
+            elif app.get('state') in ('DEPLOYING', 'CRASHED'):
+                problems.append(f"{app['id']} is {app['state']}")
+    return problems or None
+
+def health_check(label):
+    """Poll the section's health gates until they pass or HEALTH_TIMEOUT expires."""
+    section = config[label]
+    try:
+        expected = leaf_fingerprint(section)
+    except Exception as e:
+        record_failure(label, f"cannot read new certificate: {e}")
+        return False
+    check_ui = section.getboolean('ui_certificate_enabled', fallback=True)
+    check_apps = section.getboolean('apps_enabled', fallback=False)
+    deadline = time.monotonic() + HEALTH_TIMEOUT
+    while True:
+        reason = None
+        try:
+            if check_ui:
+                served = served_fingerprint(section)
+                if served != expected:
+                    reason = f"UI is serving {served}, expected {expected}"
+            if reason is None and check_apps:
+                problems = app_problems(section, label, expected)
+                if problems:
+                    reason = "apps not healthy: " + ", ".join(problems)
+        except Exception as e:
+            reason = f"health check error: {e}"
+        if reason is None:
+            logger.info(f"✅ {label} passed health checks.")
+            return True
+        if time.monotonic() >= deadline:
+            record_failure(label, f"health checks failed after {HEALTH_TIMEOUT}s, {reason}")
+            return False
+        logger.debug(f"Waiting for {label}: {reason}")
+        time.sleep(HEALTH_INTERVAL)
+
+#
+# Roll out
+#
+
+plan = plan_waves(SECTIONS, CANARY, WAVES)
+logger.info(f"Deploying to {len(SECTIONS)} section(s) in {len(plan)} wave(s).")
+
+with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+    for number, wave in enumerate(plan, 1):
+        logger.info(f"Starting wave {number}/{len(plan)}: {', '.join(wave)}")
+        deployed, skipped = deploy_wave(pool, wave)
+        healthy = list(pool.map(health_check, deployed))
+        logger.info(f"Wave {number} finished: {sum(healthy)}/{len(wave)} healthy.")
+        if number == 1 and CANARY > 0 and sum(healthy) < len(wave):
+            logger.critical(f"Canary wave failed ({len(wave) - sum(healthy)} of {len(wave)} section(s) "
+                            f"not healthy). Stopping rollout, {len(SECTIONS) - len(wave)} section(s) not attempted.")
+            sys.exit(1)
+        if budget_exhausted():
+            not_attempted = len(skipped) + sum(len(w) for w in plan[number:])
+            logger.critical(f"Too many failures ({failures}, {MAX_FAILURES} allowed). "
+                            f"Stopping rollout, {not_attempted} section(s) not attempted.")
+            sys.exit(1)
+
+if failures:
+    logger.warning(f"deploy_fleet finished with {failures} failure(s).")
+    sys.exit(1)
+logger.info("deploy_fleet finished.")